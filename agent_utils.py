@@ -0,0 +1,27 @@
+import hashlib
+from pathlib import Path
+
+from strands.agent import AgentResult
+
+# Helpers shared by app.py and main.py, keeping the session layout on disk and the response text identical across both
+
+#%% --- Session Layout
+# Caller supplied ids are hashed into fixed-length names, which also keeps them from escaping the sessions folder
+def hash_id(value: str) -> str:
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+# Users are spread over two bucket levels (sessions/ab/cd/abcd...), so no folder grows past a few hundred entries
+def user_session_dir(sessions_path: Path, user_id: str) -> Path:
+    user_hash = hash_id(user_id)
+    return sessions_path / user_hash[:2] / user_hash[2:4] / user_hash
+
+# Messages folder written by FileSessionManager for the default agent of a session
+def session_messages_dir(sessions_path: Path, user_id: str, session_id: str) -> Path:
+    session_dir = user_session_dir(sessions_path, user_id) / f"session_{hash_id(session_id)}"
+    return session_dir / "agents" / "agent_default" / "messages"
+
+#%% --- Agent Results
+def extract_text(agent_result: AgentResult) -> str:
+    """Joins the text blocks of the agent's final message, falling back to str() when there are none."""
+    content = (agent_result.message or {}).get("content", [])
+    return "".join(item["text"] for item in content if "text" in item) or str(agent_result)
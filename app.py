@@ -1,20 +1,22 @@
 from collections.abc import Callable
-from typing import Iterator, Dict, Optional, Any
+from typing import Annotated, Iterator, Dict, Optional, Any
 from uuid import uuid4
 from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.responses import StreamingResponse, PlainTextResponse
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 import uvicorn
 from strands import Agent, tool
 from strands_tools import http_request
 import os
-from fastapi.responses import HTMLResponse
 
 
 #%% --- Environment Variables
 import os
+import logging
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 load_dotenv(".env")
 GEMINI_API = os.getenv("GEMINI_API_KEY")
 #OPENROUTER_API = os.getenv("OPENROUTER_API_KEY") Not Being Used
@@ -25,13 +27,16 @@ GEMINI_API = os.getenv("GEMINI_API_KEY")
 # Enables the model to remember about previous messages but increase context window
 from strands.session.file_session_manager import FileSessionManager
 from pathlib import Path
+# Ids are hashed and users bucketed into sessions/ab/cd/<user hash>/, see agent_utils.py
+from agent_utils import extract_text, hash_id, user_session_dir, session_messages_dir
 
 BASE_PATH = Path(__file__).resolve().parent
+SESSIONS_PATH = BASE_PATH / "sessions"
 
 def create_session_manager(user_id, session_id):
-    session_dir = BASE_PATH / "sessions" / user_id
+    session_dir = user_session_dir(SESSIONS_PATH, user_id)
     session_manager = FileSessionManager(
-        session_id=f"{session_id}",
+        session_id=hash_id(session_id),
         storage_dir=session_dir
     )
     return session_manager
@@ -41,61 +46,27 @@ def create_session_manager(user_id, session_id):
 # Enables the model to remember about previous messages but increase context window
 from strands.agent.conversation_manager import SlidingWindowConversationManager
 
-sliding_window_conversation_manager = SlidingWindowConversationManager(
-    window_size=20,  # Maximum number of messages to keep
-    should_truncate_results=True, # Enable truncating the tool result when a message is too large for the model's context window 
-)
+# A new manager is built for every agent: it keeps per-agent state (removed message count)
+def create_conversation_manager(window_size=20):
+    conversation_manager = SlidingWindowConversationManager(
+        window_size=window_size,  # Maximum number of messages to keep
+        should_truncate_results=True, # Enable truncating the tool result when a message is too large for the model's context window 
+    )
+    return conversation_manager
 
 
 #%% --- System Prompt
-# Instructions given to the model to set the behavior of the agent
-# You can modify this prompt to change the agent's behavior
-CARBON_SYSTEM_PROMPT = """You are an AI Agent specialized in carbon footprint analysis of architectural projects.
-
-Your main task is to analyze the contents of a given URL (which may include text, images, PDFs, BIM models, or other documents) describing an architectural project and then:
-
-Extract relevant information such as:
-
-Project type (residential, commercial, industrial, etc.)
-Location (country, climate zone, urban/rural setting)
-Building size (floor area, height, number of floors)
-Construction materials and quantities (concrete, steel, wood, glass, insulation, finishes, etc.)
-Energy systems (HVAC, lighting, renewable sources, fossil-fuel use)
-Water and waste management systems
-Transportation or mobility considerations (e.g., parking, bike storage, public transit proximity)
-
-Estimate carbon footprint for each stage of the building lifecycle:
-
-Embodied carbon (extraction, manufacturing, transport, and construction of materials)
-Operational carbon (heating, cooling, electricity, water use, lighting, appliances over the building’s lifespan)
-End-of-life carbon (demolition, disposal, recycling potential)
-
-Provide outputs in a structured format, including:
-
-Total estimated carbon footprint (in kgCO₂e or tCO₂e)
-Breakdown by lifecycle stage (embodied, operational, end-of-life)
-Key drivers of emissions (e.g., high cement use, inefficient HVAC, lack of renewable energy)
-Suggested alternatives or mitigation strategies (e.g., use of low-carbon concrete, more insulation, renewable energy integration, timber instead of steel, passive design strategies).
-
-Communicate clearly, using:
-
-Numerical estimates with clear units (kgCO₂e/m², total tCO₂e)
-Tables or bullet points where appropriate
-A short plain-language summary for non-experts
-
-Constraints:
-
-If the URL lacks sufficient data, state assumptions clearly and explain uncertainties.
-Follow recognized frameworks such as IPCC guidelines, LEED, BREEAM, or RICS Whole Life Carbon Assessment whenever possible.
-Be transparent about data sources, assumptions, and calculation methods.
-
-Your goal is to provide a reliable, structured, and actionable carbon footprint analysis to help architects, engineers, and stakeholders make informed decisions about sustainability.
-"""
+# Instructions given to the model to set the behavior of the agent, edit them in prompts.py
+from prompts import CARBON_SYSTEM_PROMPT
 
 class PromptRequest(BaseModel):
-    prompt: str
-    user_id: str
-    session_id: str
+    # Unknown fields are rejected and text fields are bounded to keep request parsing cheap
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
+    prompt: Annotated[str, Field(max_length=32_000)]
+    user_id: Annotated[str, Field(max_length=128)]
+    session_id: Annotated[str, Field(max_length=128)]
+    window_size: Annotated[int, Field(ge=1, le=1000)] = 20
 
 #%% --- Models
 # For custom model configuration check following links:
@@ -103,9 +74,30 @@ class PromptRequest(BaseModel):
 # LiteLLM Docs: https://docs.litellm.ai/docs/
 # Gemini  Docs: https://docs.litellm.ai/docs/providers/gemini 
 from strands.models.litellm import LiteLLMModel
+import httpx
+import litellm
+from urllib.request import getproxies
+from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler, get_ssl_configuration
+
+# One pooled HTTP client shared by all Gemini calls of the worker: TCP/TLS connections are kept alive
+# between calls and HTTP/2 multiplexes concurrent requests over them. Closed on shutdown (see lifespan)
+# A custom transport bypasses LiteLLM's own SSL and proxy setup, so it is applied here:
+# SSL_VERIFY / SSL_CERT_FILE / SSL_CERTIFICATE and the HTTPS_PROXY environment variable
+gemini_http_client = AsyncHTTPHandler(
+    timeout=60.0,
+    transport=httpx.AsyncHTTPTransport(
+        verify=get_ssl_configuration(),
+        cert=os.getenv("SSL_CERTIFICATE", litellm.ssl_certificate),
+        proxy=getproxies().get("https"),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        http2=True,
+    ),
+)
+
 model = LiteLLMModel(
     client_args={
         "api_key": os.getenv("GEMINI_API_KEY"),
+        "client": gemini_http_client,
     },
     # **model_config
     #model_id="anthropic/claude-3-7-sonnet-20250219", 
@@ -118,42 +110,173 @@ model = LiteLLMModel(
 )
 
 
+#%% --- Agent Factory & Cache
+# Agents are reused across requests of the same session instead of being rebuilt on every call.
+# Strands agents hold per-call state, so a lock per session allows only one in-flight call per agent.
+# A cached agent is only reused while the session messages on disk are unchanged,
+# so writes from another worker process make the next request rebuild it from disk.
+import asyncio
+import weakref
+from contextlib import asynccontextmanager
+
+AGENT_CACHE_SIZE = 512
+_agent_cache = {}  # (user_id, session_id) -> (agent config, agent), oldest first
+_session_locks = weakref.WeakValueDictionary()  # (user_id, session_id) -> asyncio.Lock
+
+# Defined once at module level, the streaming generator detects its tool-use event to switch to the summary
+@tool
+def ready_to_summarize():
+    """
+    A tool that is intended to be called by the agent right before summarize the response.
+    """
+    return "Ok - continue providing the summary!"
+
+def create_carbon_agent(user_id, session_id, window_size=20, is_streaming_mode=False):
+    tools = [http_request]
+
+    if is_streaming_mode:
+        tools.append(ready_to_summarize)
+
+    carbon_agent = Agent(
+        model=model,
+        system_prompt=CARBON_SYSTEM_PROMPT,
+        state={"user_id": user_id, "session_id": session_id},
+        tools=tools,
+        session_manager=create_session_manager(user_id, session_id),
+        conversation_manager=create_conversation_manager(window_size),
+        callback_handler=None
+    )
+    return carbon_agent
+
+def session_stamp(user_id, session_id):
+    """Last modification time of the session messages folder, None for new sessions."""
+    messages_dir = session_messages_dir(SESSIONS_PATH, user_id, session_id)
+    try:
+        return messages_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+@asynccontextmanager
+async def checkout_carbon_agent(user_id, session_id, window_size=20, is_streaming_mode=False):
+    """
+    Yields the cached agent of a session (or a new one) and holds the session lock while it is in use.
+    The agent is cached again only if the call succeeded.
+    """
+    key = (user_id, session_id)
+    lock = _session_locks.get(key)
+    if lock is None:
+        lock = _session_locks[key] = asyncio.Lock()
+
+    async with lock:
+        config, carbon_agent = _agent_cache.pop(key, (None, None))
+        if config != (window_size, is_streaming_mode, session_stamp(user_id, session_id)):
+            carbon_agent = create_carbon_agent(user_id, session_id, window_size, is_streaming_mode)
+
+        yield carbon_agent
+
+        _agent_cache[key] = ((window_size, is_streaming_mode, session_stamp(user_id, session_id)), carbon_agent)
+        if len(_agent_cache) > AGENT_CACHE_SIZE:
+            del _agent_cache[next(iter(_agent_cache))]
+
+
+#%% --- Concurrency Limit
+# Bounds the in-flight Gemini calls of each worker, so traffic spikes wait here instead of failing upstream (429)
+# The limits are per worker process, the server-wide cap is GEMINI_MAX_CONCURRENCY x number of workers (see README)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "50"))
+GEMINI_MAX_QUEUE = int(os.getenv("GEMINI_MAX_QUEUE", "100"))  # Waiting requests before answering 503 + Retry-After
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+gemini_pending = 0  # Requests holding or waiting for a slot
+
+def gemini_queue_full():
+    return gemini_pending >= GEMINI_MAX_CONCURRENCY + GEMINI_MAX_QUEUE
+
+@asynccontextmanager
+async def gemini_slot():
+    global gemini_pending
+    gemini_pending += 1
+    try:
+        async with gemini_semaphore:
+            yield
+    finally:
+        gemini_pending -= 1
+
+def busy_error():
+    return HTTPException(status_code=503, detail="Server busy, please retry later", headers={"Retry-After": "5"})
+
+
+#%% --- Response Cache
+# Identical prompts resent to the same session within a few seconds (network retries, double clicks)
+# are answered from memory instead of running the agent again. Used by the non-streaming endpoint only.
+import re
+import hashlib
+from cachetools import TTLCache
+
+response_cache = TTLCache(maxsize=1024, ttl=30)
+VOLATILE_PROMPT = re.compile(r"\b(now|today|latest|current(ly)?)\b", re.IGNORECASE)
+
+def response_cache_key(request):
+    """Cache key of a request, None for prompts asking for time-dependent answers."""
+    if VOLATILE_PROMPT.search(request.prompt):
+        return None
+    key = "\0".join((request.user_id, request.session_id, request.prompt))
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
 #%% --- API Endpoints
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI(title="Carbon Footprint API")
+from fastapi.responses import ORJSONResponse
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await gemini_http_client.close()
+
+# JSON responses are serialized with orjson instead of the standard json module
+app = FastAPI(title="Carbon Footprint API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 # --- ADD CORS MIDDLEWARE HERE ---
-origins = [
-    "*",
-    "http://localhost",
-    "http://localhost:8000",  # Your local FastAPI default port
-    "http://127.0.0.1",
-    "http://127.0.0.1:8000",
-    # The browser sends Origin: null for file:// requests.
-    "null",
-    # Add any other specific origins your frontend might run on, e.g.,
-    # "http://your-frontend-domain.com",
-]
+# The front-end sends no cookies or auth headers, so every origin (including "null" for file:// pages)
+# is allowed without credentials, which lets the middleware answer with a static "*" header.
+# To restrict access, list the allowed origins instead, e.g. ["http://your-frontend-domain.com"],
+# and only then set allow_credentials=True if the front-end needs to send cookies.
+origins = ["*"]
 
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
-    allow_credentials=True,
+    allow_credentials=False,
     allow_methods=["*"],  # Allow all methods (GET, POST, PUT, DELETE, etc.)
     allow_headers=["*"],  # Allow all headers
 )
 
+# FastAPI's built-in error handlers answer with the standard JSONResponse, so errors are serialized with orjson too.
+# Registered for Starlette's HTTPException so routing errors (404, 405) are covered as well
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+@app.exception_handler(StarletteHTTPException)
+async def http_exception_handler(request: Request, exc: StarletteHTTPException):
+    # exc.headers is kept so the 503 from busy_error() still carries Retry-After
+    return ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse({"detail": jsonable_encoder(exc.errors())}, status_code=422)
+
 #%% --- Serve index.html
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse 
+from fastapi.responses import FileResponse
+
+INDEX_HTML_PATH = BASE_PATH / "index.html"
 
 app.mount("/static", StaticFiles(directory="."), name="static") 
 
-@app.get("/", response_class=HTMLResponse)
+@app.get("/")
 async def read_root():
-    with open("index.html", "r", encoding="utf-8") as f:
-        return f.read()
+    # FileResponse streams the file (sendfile when available) and sets ETag / Last-Modified headers
+    return FileResponse(INDEX_HTML_PATH, media_type="text/html", headers={"Cache-Control": "public, max-age=3600"})
 
 #%% --- Agent Enpoints (Non-Streaming and Streaming)
 @app.get('/health')
@@ -169,86 +292,104 @@ async def get_carbon(request: PromptRequest):
     if not prompt:
         raise HTTPException(status_code=400, detail="No prompt provided")
 
-    try:
-        carbon_agent = Agent(
-            model=model,
-            system_prompt=CARBON_SYSTEM_PROMPT,
-            state={"user_id": request.user_id, "session_id": request.session_id},
-            tools=[http_request],
-            session_manager=create_session_manager(request.user_id, request.session_id),
-            conversation_manager=sliding_window_conversation_manager
-        )
-        response = carbon_agent(prompt)
-        content = str(response)
-        return PlainTextResponse(content=content)
-    except Exception as e:
-        return PlainTextResponse(content=f"Error: {str(e)}", status_code=500)
+    cache_key = response_cache_key(request)
+    content = response_cache.get(cache_key)  # Single lookup, an entry may expire between two
+    if content is not None:
+        return PlainTextResponse(content=content, headers={"X-Cache": "hit"})
+    if gemini_queue_full():
+        raise busy_error()
 
+    try:
+        async with checkout_carbon_agent(request.user_id, request.session_id, request.window_size) as carbon_agent:
+            # A duplicate of this request may have been answered while it waited for the session
+            content = response_cache.get(cache_key)
+            cache_status = "hit"
+            if content is None:
+                async with gemini_slot():
+                    response = await carbon_agent.invoke_async(prompt)
+                content = extract_text(response)
+                cache_status = "miss"
+                if cache_key is not None:
+                    response_cache[cache_key] = content
+        return PlainTextResponse(content=content, headers={"X-Cache": cache_status})
+    except Exception:
+        # Details are logged server-side only, the client gets a short fixed message
+        logger.exception("Error in /carbon endpoint")
+        return PlainTextResponse(content="Internal server error", status_code=500)
+
+
+# Pre-encoded stream chunks, Starlette sends bytes as they are instead of encoding them on every event
+STREAM_FLUSH_SIZE = 64  # Consecutive text deltas are merged until they reach this many bytes
+SUMMARY_SEPARATOR = b"\n"
+STREAM_ERROR = b"Error: internal server error"
+TOOL_BANNERS = {
+    "http_request": "\n\n🔧 Using tool: http_request".encode(),
+}
 
 async def run_carbon_agent_and_stream_response(prompt: str, request: Any):
     """
     A helper function to yield summary text chunks one by one as they come in, allowing the web server to emit
     them to caller live
     """
-    is_summarizing = False
-
-    @tool
-    def ready_to_summarize():
-        """
-        A tool that is intended to be called by the agent right before summarize the response.
-        """
-        nonlocal is_summarizing
-        is_summarizing = True
-        return "Ok - continue providing the summary!"
+    buffer = bytearray()
 
     try:
-        carbon_agent = Agent(
-            model=model,
-            system_prompt=CARBON_SYSTEM_PROMPT,
-            state={"user_id": request.user_id, "session_id": request.session_id},
-            tools=[http_request, ready_to_summarize],
-            session_manager=create_session_manager(request.user_id, request.session_id),
-            conversation_manager=sliding_window_conversation_manager,
-            callback_handler=None
-        )
-
-        async for event in carbon_agent.stream_async(prompt):
-            if "current_tool_use" in event and event["current_tool_use"].get("name"):
-                tool_name = event["current_tool_use"]["name"]
-                if tool_name == "ready_to_summarize":
-                    is_summarizing = True
-                    yield "\n" # Skip a to split reasoning & summary
-                else:
-                    yield (f"\n\n🔧 Using tool: {tool_name}") 
-
-            # Only yield data when summarizing - Can be problematic if model doesn't call the tool
-            #if not is_summarizing:
-            #    continue
-
-            elif "data" in event:
-                yield event['data']
-
-    except Exception as e:
-        yield f"Error: {str(e)}"
+        async with checkout_carbon_agent(request.user_id, request.session_id, request.window_size, is_streaming_mode=True) as carbon_agent, gemini_slot():
+            async for event in carbon_agent.stream_async(prompt):
+                # One lookup per key, text deltas (most of the events) are handled first
+                data = event.get("data")
+
+                if data is not None:
+                    buffer += data.encode()
+                    if len(buffer) >= STREAM_FLUSH_SIZE:
+                        yield bytes(buffer)
+                        buffer.clear()
+                    continue
+
+                tool_use = event.get("current_tool_use")
+                tool_name = tool_use.get("name") if tool_use else None
+                if tool_name:
+                    if buffer:
+                        yield bytes(buffer)
+                        buffer.clear()
+                    if tool_name == "ready_to_summarize":
+                        yield SUMMARY_SEPARATOR # Skip a to split reasoning & summary
+                    else:
+                        yield TOOL_BANNERS.get(tool_name) or f"\n\n🔧 Using tool: {tool_name}".encode()
+
+        if buffer:
+            yield bytes(buffer)
+
+    except Exception:
+        logger.exception("Error in /carbon-streaming endpoint")
+        if buffer:
+            yield bytes(buffer)
+        yield STREAM_ERROR
 
 
 @app.post('/carbon-streaming')
 async def get_carbon_streaming(request: PromptRequest):
     """Endpoint to stream the carbon footprint summary as it comes it, not all at once at the end."""
-    try:
-        prompt = request.prompt
-
-        if not prompt:
-            raise HTTPException(status_code=400, detail="No prompt provided")
+    prompt = request.prompt
 
-        return StreamingResponse(
-            run_carbon_agent_and_stream_response(prompt, request),
-            media_type="text/plain"
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    if not prompt:
+        raise HTTPException(status_code=400, detail="No prompt provided")
+    if gemini_queue_full():
+        raise busy_error()
+
+    # Disable proxy (e.g. nginx) buffering so chunks reach the browser as they are generated
+    # Keep this route out of any compression middleware (e.g. GZipMiddleware), which buffers too
+    return StreamingResponse(
+        run_carbon_agent_and_stream_response(prompt, request),
+        media_type="text/plain",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
 
 if __name__ == '__main__':
     # Get port from environment variable or default to 8000
     port = int(os.environ.get('PORT', 8000))
-    uvicorn.run(app, host='0.0.0.0', port=port)
\ No newline at end of file
+    # Worker processes, from WEB_CONCURRENCY or defaulting to (2 x CPU cores) + 1
+    workers = int(os.environ.get('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+    # The "app:app" import string is required to run multiple workers
+    # uvloop and httptools (from uvicorn[standard]) are picked automatically when installed
+    uvicorn.run("app:app", host='0.0.0.0', port=port, workers=workers, log_level="warning")
\ No newline at end of file
@@ -1,18 +1,23 @@
 # app.py (or any name you prefer for a single Flask file)
 
-from collections.abc import Callable
-from typing import Iterator, Dict, Optional, Any, List
+from collections.abc import AsyncIterator, Callable
+from typing import Annotated, Iterator, Dict, Optional, Any, List, Tuple
 from uuid import uuid4
 import os
 from pathlib import Path
 import asyncio
+import threading
+import weakref
+from contextlib import contextmanager
 
 # Flask specific imports
 from flask import Flask, request, jsonify, Response, render_template, abort, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+import orjson
 
 # Pydantic for request body validation (still useful even in Flask for schema definition)
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
 
 # Strands imports
 from strands import Agent, tool
@@ -44,89 +49,48 @@ STATIC_FILES_DIR: Path = BASE_DIR # Assuming index.html is in BASE_DIR, adjust i
 INDEX_HTML_PATH: Path = BASE_DIR / "index.html"
 
 # Agent Configuration
-SLIDING_WINDOW_SIZE: int = 20
+SLIDING_WINDOW_SIZE: int = 20 # Default, can be overridden per request
+AGENT_CACHE_SIZE: int = 512 # Maximum number of session agents kept in memory
 
 # CORS Origins
-CORS_ORIGINS: List[str] = [
-    "*", # For broad access during development, tighten in production
-    "http://localhost",
-    "http://localhost:8000",
-    "http://127.0.0.1",
-    "http://127.0.0.1:8000",
-    "null",  # For file:// requests (browser's origin for local files)
-    "https://rickkk856.pythonanywhere.com", # Example production domain
-    # Add any other specific origins your frontend might run on
-]
+# No cookies or auth headers are used, so any origin is allowed without credentials.
+# Tighten in production by listing the origins instead, e.g. "https://rickkk856.pythonanywhere.com"
+CORS_ORIGINS: List[str] = ["*"]
 
 # System Prompt
-CARBON_SYSTEM_PROMPT: str = """You are an AI Agent specialized in carbon footprint analysis of architectural projects.
+from prompts import CARBON_SYSTEM_PROMPT
 
-Your main task is to analyze the contents of a given URL (which may include text, images, PDFs, BIM models, or other documents) describing an architectural project and then:
-
-Extract relevant information such as:
-
-Project type (residential, commercial, industrial, etc.)
-Location (country, climate zone, urban/rural setting)
-Building size (floor area, height, number of floors)
-Construction materials and quantities (concrete, steel, wood, glass, insulation, finishes, etc.)
-Energy systems (HVAC, lighting, renewable sources, fossil-fuel use)
-Water and waste management systems
-Transportation or mobility considerations (e.g., parking, bike storage, public transit proximity)
-
-Estimate carbon footprint for each stage of the building lifecycle:
-
-Embodied carbon (extraction, manufacturing, transport, and construction of materials)
-Operational carbon (heating, cooling, electricity, water use, lighting, appliances over the building’s lifespan)
-End-of-life carbon (demolition, disposal, recycling potential)
-
-Provide outputs in a structured format, including:
-
-Total estimated carbon footprint (in kgCO₂e or tCO₂e)
-Breakdown by lifecycle stage (embodied, operational, end-of-life)
-Key drivers of emissions (e.g., high cement use, inefficient HVAC, lack of renewable energy)
-Suggested alternatives or mitigation strategies (e.g., use of low-carbon concrete, more insulation, renewable energy integration, timber instead of steel, passive design strategies).
-
-Communicate clearly, using:
-
-Numerical estimates with clear units (kgCO₂e/m², total tCO₂e)
-Tables or bullet points where appropriate
-A short plain-language summary for non-experts
-
-Constraints:
-
-If the URL lacks sufficient data, state assumptions clearly and explain uncertainties.
-Follow recognized frameworks such as IPCC guidelines, LEED, BREEAM, or RICS Whole Life Carbon Assessment whenever possible.
-Be transparent about data sources, assumptions, and calculation methods.
-
-Your goal is to provide a reliable, structured, and actionable carbon footprint analysis to help architects, engineers, and stakeholders make informed decisions about sustainability.
-"""
+# Session layout & response helpers shared with app.py
+from agent_utils import extract_text, hash_id, session_messages_dir, user_session_dir
 
 # Pydantic Model for incoming request data
 class PromptRequest(BaseModel):
-    prompt: str
-    user_id: str
-    session_id: str
+    # Unknown fields are rejected and text fields are bounded to keep request parsing cheap
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
+    prompt: Annotated[str, Field(max_length=32_000)]
+    user_id: Annotated[str, Field(max_length=128)]
+    session_id: Annotated[str, Field(max_length=128)]
+    window_size: Annotated[int, Field(ge=1, le=1000)] = SLIDING_WINDOW_SIZE
+
+# --- 2. Strands Session Manager ---
 
-# --- 2. Strands Session & Conversation Managers ---
+# Created once at import, so it also exists when served by a WSGI server (which skips __main__).
+# Per-user folders are not created here: FileSessionManager makes its storage_dir whenever it is built.
+SESSIONS_BASE_PATH.mkdir(parents=True, exist_ok=True)
 
 def create_session_manager(user_id: str, session_id: str) -> FileSessionManager:
     """
     Creates and returns a FileSessionManager instance for a given user and session.
-    Sessions are stored in SESSIONS_BASE_PATH/{user_id}/{session_id}.
+    Sessions are stored in agent_utils.user_session_dir(...)/session_{hash_id(session_id)}, the layout shared with app.py.
     """
-    session_dir = SESSIONS_BASE_PATH / user_id
-    session_dir.mkdir(parents=True, exist_ok=True) # Ensure directory exists
+    session_dir = user_session_dir(SESSIONS_BASE_PATH, user_id)
     session_manager = FileSessionManager(
-        session_id=session_id,
+        session_id=hash_id(session_id),
         storage_dir=session_dir
     )
     return session_manager
 
-sliding_window_conversation_manager = SlidingWindowConversationManager(
-    window_size=SLIDING_WINDOW_SIZE,
-    should_truncate_results=True,
-)
-
 # --- 3. Strands LLM Model ---
 # This is initialized once globally
 llm_model = LiteLLMModel(
@@ -148,14 +112,16 @@ def ready_to_summarize_signal_tool():
     """
     return "Agent is now ready to provide the summary."
 
-# --- 5. Agent Factory Function ---
+# --- 5. Agent Factory & Cache ---
 def create_carbon_agent(
     user_id: str,
     session_id: str,
-    is_streaming_mode: bool = False
+    is_streaming_mode: bool = False,
+    window_size: int = SLIDING_WINDOW_SIZE
 ) -> Agent:
     """
     Factory function to create and configure an Agent instance for carbon footprint analysis.
+    A fresh conversation manager is created per agent, as it keeps per-agent state.
     """
     agent_tools: List[Any] = [http_request]
 
@@ -168,13 +134,144 @@ def create_carbon_agent(
         state={"user_id": user_id, "session_id": session_id},
         tools=agent_tools,
         session_manager=create_session_manager(user_id, session_id),
-        conversation_manager=sliding_window_conversation_manager,
+        conversation_manager=SlidingWindowConversationManager(
+            window_size=window_size,
+            should_truncate_results=True,
+        ),
         callback_handler=None
     )
 
+# Agents are reused across requests of the same session: (user_id, session_id) -> (agent config, agent)
+_agent_cache: Dict[Tuple[str, str], Tuple[Tuple[Any, ...], Agent]] = {}
+_agent_cache_lock = threading.Lock()
+_session_locks: "weakref.WeakValueDictionary[Tuple[str, str], Any]" = weakref.WeakValueDictionary()
+
+def session_stamp(user_id: str, session_id: str) -> Optional[int]:
+    """
+    Returns the last modification time of the session messages folder, or None for new sessions.
+    """
+    messages_dir = session_messages_dir(SESSIONS_BASE_PATH, user_id, session_id)
+    try:
+        return messages_dir.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+@contextmanager
+def checkout_carbon_agent(
+    user_id: str,
+    session_id: str,
+    is_streaming_mode: bool = False,
+    window_size: int = SLIDING_WINDOW_SIZE
+) -> Iterator[Agent]:
+    """
+    Yields the cached Agent of a session, creating it when missing or outdated.
+    Strands agents keep per-call state, so a per-session lock allows one in-flight call per agent.
+    A cached agent is only reused while the session messages on disk are unchanged, so writes
+    from another worker process force a rebuild. The agent is cached again only if the call succeeded.
+    """
+    key = (user_id, session_id)
+    with _agent_cache_lock:
+        session_lock = _session_locks.get(key)
+        if session_lock is None:
+            session_lock = _session_locks[key] = threading.Lock()
+
+    with session_lock:
+        with _agent_cache_lock:
+            config, carbon_agent = _agent_cache.pop(key, (None, None))
+        if config != (window_size, is_streaming_mode, session_stamp(user_id, session_id)):
+            carbon_agent = create_carbon_agent(user_id, session_id, is_streaming_mode, window_size)
+
+        yield carbon_agent
+
+        config = (window_size, is_streaming_mode, session_stamp(user_id, session_id))
+        with _agent_cache_lock:
+            _agent_cache[key] = (config, carbon_agent)
+            if len(_agent_cache) > AGENT_CACHE_SIZE:
+                del _agent_cache[next(iter(_agent_cache))]
+
+_STREAM_END = object()
+
+def _iterate_on_new_loop(async_iterator: AsyncIterator[Any]) -> Iterator[Any]:
+    """
+    Python 3.10 fallback for iterate_async_events (asyncio.Runner is 3.11+).
+    Every task copies the current Context when it is created, so running each step as its own task
+    would hand Strands a fresh copy every time. Instead a single pump task consumes the whole
+    iterator in one Context and hands the items over through a queue of size 1.
+    """
+    loop = asyncio.new_event_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def pump() -> None:
+        try:
+            async for item in async_iterator:
+                await queue.put((item, None))
+            await queue.put((_STREAM_END, None))
+        except Exception as error:
+            await queue.put((_STREAM_END, error))
+        finally:
+            # Closed inside the pump task, so it runs in the same Context as the steps
+            await async_iterator.aclose()
+
+    pump_task = loop.create_task(pump())
+    try:
+        while True:
+            item, error = loop.run_until_complete(queue.get())
+            if error is not None:
+                raise error
+            if item is _STREAM_END:
+                break
+            yield item
+    finally:
+        try:
+            pump_task.cancel()
+            loop.run_until_complete(asyncio.gather(pump_task, return_exceptions=True))
+            # Same shutdown as asyncio.run(): cancel leftover tasks, then async generators and the executor
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            loop.run_until_complete(loop.shutdown_default_executor())
+        finally:
+            loop.close()
+
+def iterate_async_events(async_iterator: AsyncIterator[Any]) -> Iterator[Any]:
+    """
+    Drives an async iterator from synchronous (WSGI) code on a private event loop,
+    yielding each item as soon as it is produced instead of collecting them all first.
+    asyncio.Runner runs every step in the same contextvars Context (Strands' tracing context
+    spans several steps) and its close() cancels leftover tasks, async generators and the executor.
+    """
+    if not hasattr(asyncio, "Runner"):
+        yield from _iterate_on_new_loop(async_iterator)
+        return
+    with asyncio.Runner() as runner:
+        try:
+            while True:
+                try:
+                    yield runner.run(async_iterator.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            # Also runs when the client disconnects, so the agent stream is closed cleanly
+            runner.run(async_iterator.aclose())
+
 # --- 6. Flask Application Setup ---
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson, used by jsonify() instead of the standard json module.
+    Types orjson doesn't know are still converted by Flask's default handler.
+    """
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder=str(STATIC_FILES_DIR), static_url_path='/static')
-CORS(app, origins=CORS_ORIGINS, supports_credentials=True)
+app.json = ORJSONProvider(app)
+CORS(app, origins=CORS_ORIGINS)
 
 # --- 7. Flask Endpoints ---
 
@@ -187,7 +284,7 @@ def read_root():
         abort(404, description=f"'{INDEX_HTML_PATH.name}' not found at {INDEX_HTML_PATH.parent}")
     
     # Flask provides send_file for serving files directly, which is generally better.
-    return send_from_directory(INDEX_HTML_PATH.parent, INDEX_HTML_PATH.name)
+    return send_from_directory(INDEX_HTML_PATH.parent, INDEX_HTML_PATH.name, conditional=True) # Honors If-Modified-Since / ETag
 
 @app.route('/health')
 def health_check():
@@ -201,58 +298,45 @@ def get_carbon():
     The full response is returned once the agent has completed its processing.
     """
     try:
-        request_data = PromptRequest(**request.get_json())
+        # Pydantic parses the raw body directly, invalid JSON is reported as a ValidationError too
+        request_data = PromptRequest.model_validate_json(request.get_data())
     except ValidationError as e:
-        return jsonify({"detail": e.errors()}), 400
-    except Exception:
-        return jsonify({"detail": "Invalid JSON request body."}), 400
+        return jsonify({"detail": e.errors(include_url=False, include_context=False, include_input=False)}), 400
 
     if not request_data.prompt:
         return jsonify({"detail": "No prompt provided in the request."}), 400
 
     try:
-        carbon_agent = create_carbon_agent(
+        with checkout_carbon_agent(
             user_id=request_data.user_id,
             session_id=request_data.session_id,
-            is_streaming_mode=False
-        )
-        #agent_result = asyncio.run(carbon_agent(request_data.prompt))
-        agent_result = carbon_agent(request_data.prompt)
-
-        # --- CRUCIAL CHANGE HERE: Extract the text content ---
-        # AgentResult.message is a dict, message['content'] is a list of dicts.
-        # We assume the first item in content has the 'text' key.
-        response_text = ""
-        if agent_result and agent_result.message and agent_result.message.get('content'):
-            for item in agent_result.message['content']:
-                if 'text' in item:
-                    response_text += item['text']
-                    # If you only expect one text block, you can break here:
-                    # break
-        else:
-            # Fallback if content structure is unexpected
-            response_text = str(agent_result) # or an appropriate error message
-        # --- END CRUCIAL CHANGE ---
+            is_streaming_mode=False,
+            window_size=request_data.window_size
+        ) as carbon_agent:
+            #agent_result = asyncio.run(carbon_agent(request_data.prompt))
+            agent_result = carbon_agent(request_data.prompt)
+
+        # Text blocks of the final message, joined in a single pass (shared with app.py)
+        response_text = extract_text(agent_result)
 
         return Response(response_text, mimetype="text/plain")
-    except Exception as e:
+    except Exception:
+        # Details go to the log only, the client gets a short fixed message
         app.logger.exception("Error in /carbon endpoint") # Use Flask's logger for better debugging
-        return jsonify({"detail": f"An error occurred: {str(e)}"}), 500
+        return jsonify({"detail": "Internal server error."}), 500
 
 @app.route('/carbon-streaming', methods=['POST'])
 def get_carbon_streaming():
     """
-    Endpoint to 'stream' the carbon footprint summary.
-    Due to WSGI's synchronous nature and Strands's async streaming, this collects
-    all data first using asyncio.run() and then yields it in chunks.
-    It does NOT provide real-time streaming from the LLM.
+    Endpoint to stream the carbon footprint summary as it comes in.
+    The async Strands stream is driven event by event from the WSGI worker thread,
+    so each chunk is sent to the client as soon as the LLM produces it.
     """
     try:
-        request_data = PromptRequest(**request.get_json())
+        # Pydantic parses the raw body directly, invalid JSON is reported as a ValidationError too
+        request_data = PromptRequest.model_validate_json(request.get_data())
     except ValidationError as e:
-        return jsonify({"detail": e.errors()}), 400
-    except Exception:
-        return jsonify({"detail": "Invalid JSON request body."}), 400
+        return jsonify({"detail": e.errors(include_url=False, include_context=False, include_input=False)}), 400
 
     if not request_data.prompt:
         return jsonify({"detail": "No prompt provided in the request."}), 400
@@ -260,46 +344,45 @@ def get_carbon_streaming():
     def generate_streaming_response():
         """
         Helper generator function for the streaming endpoint.
-        It runs the async agent stream and yields collected chunks.
+        It yields each chunk of the agent stream as soon as it is received.
         """
-        carbon_agent = create_carbon_agent(
-            user_id=request_data.user_id,
-            session_id=request_data.session_id,
-            is_streaming_mode=True
-        )
-
-        all_events = []
-        async def collect_events():
-            async for event in carbon_agent.stream_async(request_data.prompt):
-                all_events.append(event)
-        
         try:
-            asyncio.run(collect_events())
-        except Exception as e:
+            with checkout_carbon_agent(
+                user_id=request_data.user_id,
+                session_id=request_data.session_id,
+                is_streaming_mode=True,
+                window_size=request_data.window_size
+            ) as carbon_agent:
+                for event in iterate_async_events(carbon_agent.stream_async(request_data.prompt)):
+                    # One lookup per key, text deltas (most of the events) are handled first
+                    data = event.get("data")
+                    if data is not None:
+                        # --- CRUCIAL CHANGE HERE: 'data' event already contains the text ---
+                        # 'data' events from agent.stream_async() are designed to yield
+                        # the raw text chunks directly from the LLM. So, we just yield it.
+                        yield data
+                        continue
+
+                    tool_use = event.get("current_tool_use")
+                    tool_name = tool_use.get("name") if tool_use else None
+                    if tool_name:
+                        if tool_name == ready_to_summarize_signal_tool.__name__:
+                            yield "\n\n--- Agent is generating summary ---\n\n"
+                        else:
+                            yield (f"\n\n🔧 Using tool: {tool_name}")
+                    # You can handle other event types here if needed, e.g., "observation"
+        except Exception:
             # Yield error message if the agent stream fails
-            yield f"\n\nError during streaming agent processing: {str(e)}"
-            return
-
-        is_summarizing = False
-        for event in all_events:
-            if "current_tool_use" in event and event["current_tool_use"].get("name"):
-                tool_name = event["current_tool_use"]["name"]
-                if tool_name == ready_to_summarize_signal_tool.__name__:
-                    is_summarizing = True
-                    yield "\n\n--- Agent is generating summary ---\n\n"
-                else:
-                    yield (f"\n\n🔧 Using tool: {tool_name}")
-            elif "data" in event:
-                # --- CRUCIAL CHANGE HERE: 'data' event already contains the text ---
-                # 'data' events from agent.stream_async() are designed to yield
-                # the raw text chunks directly from the LLM. So, we just yield it.
-                yield event['data']
-            # You can handle other event types here if needed, e.g., "observation"
-
-    return Response(generate_streaming_response(), mimetype="text/plain")
+            app.logger.exception("Error in /carbon-streaming endpoint")
+            yield "\n\nError during streaming agent processing."
+
+    # X-Accel-Buffering: no stops reverse proxies (e.g. nginx) from holding back the chunks
+    return Response(
+        generate_streaming_response(),
+        mimetype="text/plain",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
+    )
 
 # --- 8. Run Flask Application (for local development) ---
 if __name__ == '__main__':
-    # Ensure sessions directory exists on startup
-    SESSIONS_BASE_PATH.mkdir(parents=True, exist_ok=True)
     app.run(host='0.0.0.0', port=PORT, debug=True) # debug=True for development
\ No newline at end of file